@@ -1,5 +1,16 @@
+# The package import already patches through Firehose, this only makes
+# SpotCheck's reliance on a patched stdlib explicit.
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except monkey.MonkeyPatchWarning as e:
+    import sys
+    sys.stderr.write( "%s\n" % ( e, ) )
+    sys.stderr.flush()
 from .Manager import Manager
+from .utils import LcApiException
 from gevent.queue import Queue
+import gevent.event
 import gevent.pool
 import gevent
 from gevent.lock import BoundedSemaphore
@@ -7,11 +18,13 @@ import uuid
 import traceback
 import json
 import base64
+import time
+import collections
 
 class SpotCheck( object ):
     '''Representation of the process of looking for various Indicators of Compromise on the fleet.'''
 
-    def __init__( self, oid, secret_api_key, cb_check, cb_on_start_check = None, cb_on_check_done = None, cb_on_offline = None, cb_on_error = None, n_concurrent = 1, n_sec_between_online_checks = 60, extra_params = {}, is_windows = True, is_linux = True, is_macos = True, tags = None ):
+    def __init__( self, oid, secret_api_key, cb_check, cb_on_start_check = None, cb_on_check_done = None, cb_on_offline = None, cb_on_error = None, n_concurrent = 1, n_sec_between_online_checks = 60, extra_params = {}, is_windows = True, is_linux = True, is_macos = True, tags = None, manager = None ):
         '''Perform a check for specific characteristics on all hosts matching some parameters.
 
         Args:
@@ -22,46 +35,77 @@ class SpotCheck( object ):
             cb_on_start_check (func(Sensor)): callback when a sensor is starting evaluation.
             cb_on_offline (func(Sensor)): callback when a sensor is offline so checking is delayed.
             cb_on_error (func(Sensor, stackTrace)): callback when an error occurs while checking a sensor.
-            n_concurrent (int): number of sensors that should be checked concurrently, defaults to 1.
+            n_concurrent (int): number of sensors that should be checked concurrently, also the size of the worker pool, defaults to 1 if unset.
             n_sec_between_online_checks (int): number of seconds to wait between attempts to check a sensor that is offline, default to 60.
             is_windows (boolean): if True checks apply to Windows sensors, defaults to True.
             is_linux (boolean): if True checks apply to Linux sensors, defaults to True.
             is_macos (boolean): if True checks apply to MacOS sensors, defaults to True.
-            tags (str): comma-seperated list of tags sensors to check must have.
+            tags (str or list of str): comma-seperated list of tags sensors to check must have.
+            manager (Manager): optional Manager to reuse across SpotChecks, must be created with is_interactive, if None one is created from oid and secret_api_key.
         '''
         self._cbCheck = cb_check
         self._cbOnCheckDone = cb_on_check_done
         self._cbOnStartCheck = cb_on_start_check
         self._cbOnOffline = cb_on_offline
         self._cbOnError = cb_on_error
-        self._nConcurrent = n_concurrent
+        self._nConcurrent = n_concurrent if n_concurrent else 1
         self._nSecBetweenOnlineChecks = n_sec_between_online_checks
 
-        self._isWindows = is_windows
-        self._isLinux = is_linux
-        self._isMacos = is_macos
+        # Platforms to skip, empty when all platforms apply so that no
+        # sensor info needs to be fetched at all.
+        self._skipPlatforms = frozenset( p for p, isEnabled in ( ( 'windows', is_windows ), ( 'linux', is_linux ), ( 'macos', is_macos ) ) if not isEnabled )
 
-        self._tags = tags
+        if tags:
+            if not isinstance( tags, ( list, tuple, set, frozenset ) ):
+                tags = tags.split( ',' )
+            self._tags = frozenset( t.strip().lower() for t in tags )
+        else:
+            self._tags = None
 
-        self._threads = gevent.pool.Group()
+        # Bounded pool so that spawning applies backpressure instead of
+        # accumulating an unbounded number of pending greenlets.
+        self._threads = gevent.pool.Pool( size = self._nConcurrent )
         self._stopEvent = gevent.event.Event()
 
+        # Sensors are streamed from the listing into the queue, the number
+        # of newly listed sensors waiting to be checked is bounded so that
+        # the whole fleet is never held in memory. Re-checks are not bounded
+        # since the workers themselves produce them.
         self._sensorsLeftToCheck = Queue()
+        self._enumerationSlots = BoundedSemaphore( max( 256, self._nConcurrent * 4 ) )
+        self._enumerator = None
+        self._prefetchPool = gevent.pool.Pool( 64 )
+        self._isListed = False
+        self._listingError = None
         self._lock = BoundedSemaphore()
-        self._pendingReCheck = 0
-
-        self._lc = Manager( oid, secret_api_key, inv_id = 'spotcheck-%s' % str( uuid.uuid4() )[ : 4 ], is_interactive = True, extra_params = extra_params )
+        self._nChecking = 0
+        self._isDone = False
+
+        # Sensors waiting for a re-check as ( due_time, sensor ), since the
+        # delay is constant they are in order. A single scheduler greenlet
+        # re-queues them so workers never block scheduling a re-check.
+        self._reChecks = collections.deque()
+        self._reCheckAdded = gevent.event.Event()
+        self._reCheckScheduler = None
+
+        if manager is None:
+            self._lc = Manager( oid, secret_api_key, inv_id = 'spotcheck-%s' % str( uuid.uuid4() )[ : 4 ], is_interactive = True, extra_params = extra_params )
+        else:
+            if not manager._is_interactive:
+                raise LcApiException( 'Manager provided was not created with is_interactive set to True, cannot track responses.' )
+            self._lc = manager
 
     def start( self ):
         '''Start the SpotCheck process, returns immediately.
         '''
-        # We start by listing all the sensors in the org using paging.
-        for sensor in self._lc.sensors():
-            self._sensorsLeftToCheck.put( sensor )
+        # We start by listing all the sensors in the org in the background,
+        # the spot checks consume them as they come in.
+        self._enumerator = gevent.spawn( self._enumerate )
+        self._reCheckScheduler = gevent.spawn( self._scheduleReChecks )
 
-        # Now that we have a list of sensors, we'll spawn n_concurrent spot checks,
+        # Meanwhile, we spawn n_concurrent spot checks,
         for _ in range( self._nConcurrent ):
-            self._threads.add( gevent.spawn_later( 0, self._performSpotChecks ) )
+            self._threads.spawn( self._performSpotChecks )
 
         # Done, the threads will do the checks.
 
@@ -69,6 +113,10 @@ class SpotCheck( object ):
         '''Stop the SpotCheck process, returns once activity has stopped.
         '''
         self._stopEvent.set()
+        if self._enumerator is not None:
+            self._enumerator.kill()
+        self._prefetchPool.kill()
+        self._releaseWorkers()
         self._threads.join()
 
     def wait( self, timeout = None ):
@@ -79,82 +127,182 @@ class SpotCheck( object ):
 
         Returns:
             True if SpotCheck is finished, False if a timeout was specified and reached before the SpotCheck is done.
+
+        Raises:
+            the exception that interrupted listing the sensors of the organization, if any.
         '''
-        return self._threads.join( timeout = timeout )
+        isFinished = self._threads.join( timeout = timeout )
+        if isFinished and self._listingError is not None:
+            raise self._listingError
+        return isFinished
 
-    def _performSpotChecks( self ):
-        while not self._stopEvent.wait( timeout = 0 ):
-            try:
-                sensor = self._sensorsLeftToCheck.get_nowait()
-            except:
-                # Check to see if some sensors are pending a re-check
-                # after being offline.
-                with self._lock:
-                    # If there are no more sensors to check, we can exit.
-                    if 0 == self._pendingReCheck and 0 == len( self._sensorsLeftToCheck ):
-                        return
-                gevent.sleep( 2 )
-                continue
+    def isStopped( self ):
+        '''Check if the SpotCheck process has been asked to stop.
 
-            # Check to see if the platform matches
-            if self._isWindows is False or self._isLinux is False or self._isMacos is False:
-                platform = sensor.getInfo()[ 'plat' ]
-                if platform == 'windows' and not self._isWindows:
-                    continue
-                if platform == 'linux' and not self._isLinux:
-                    continue
-                if platform == 'macos' and not self._isMacos:
-                    continue
-
-            # If tags were set, check the sensor have them.
+        Returns:
+            True if stop() was called.
+        '''
+        return self._stopEvent.is_set()
+
+    def _getInfo( self, sensor ):
+        # Platform and tags do not change during a SpotCheck, so they are
+        # memoized on the Sensor across re-check attempts.
+        info = getattr( sensor, '_cached_info', None )
+        if info is None:
+            info = sensor.getInfo()
+            sensor._cached_info = info
+        return info
+
+    def _getTags( self, sensor ):
+        tags = getattr( sensor, '_cached_tags', None )
+        if tags is None:
+            tags = frozenset( t.lower() for t in sensor.getTags() )
+            sensor._cached_tags = tags
+        return tags
+
+    def _enumerate( self ):
+        # List all the sensors in the org using paging, prefetching the
+        # information the filters need concurrently.
+        try:
+            for sensor in self._lc.sensors():
+                self._enumerationSlots.acquire()
+                self._prefetchPool.spawn( self._prefetch, sensor )
+            self._prefetchPool.join()
+        except Exception as e:
+            # Without the full listing the SpotCheck cannot complete, so
+            # we stop and wait() will raise the error.
+            self._listingError = e
+            self._stopEvent.set()
+            self._releaseWorkers()
+        finally:
+            # Also reached when stop() kills the listing, no prefetch may
+            # outlive it.
+            self._prefetchPool.kill()
+            # Nothing may be left to check once the listing is over.
+            self._isListed = True
+            self._notifyIfDone()
+
+    def _prefetch( self, sensor ):
+        try:
+            if self._skipPlatforms:
+                self._getInfo( sensor )
             if self._tags is not None:
-                sensorTags = sensor.getTags()
-                if not all( [ ( x in sensorTags ) for x in self._tags ] ):
-                    continue
+                self._getTags( sensor )
+        except Exception:
+            # The worker will fetch whatever is missing itself.
+            pass
+        self._sensorsLeftToCheck.put( ( sensor, True ) )
+
+    def _reCheckLater( self, sensor ):
+        # Re-add it to sensors to check, after the timeout.
+        self._reChecks.append( ( time.time() + self._nSecBetweenOnlineChecks, sensor ) )
+        self._reCheckAdded.set()
+
+    def _scheduleReChecks( self ):
+        while True:
+            while 0 == len( self._reChecks ):
+                self._reCheckAdded.wait()
+                self._reCheckAdded.clear()
+            dueTime, sensor = self._reChecks[ 0 ]
+            gevent.sleep( max( 0, dueTime - time.time() ) )
+            self._reChecks.popleft()
+            self._sensorsLeftToCheck.put( ( sensor, False ) )
 
-            # Check to see if the sensor is online.
-            if not sensor.isOnline():
-                if self._cbOnOffline is not None:
-                    self._cbOnOffline( sensor )
-
-                # Re-add it to sensors to check, after the timeout.
-                def _doReCheck( s ):
-                    with self._lock:
-                        self._sensorsLeftToCheck.put( s )
-                        self._pendingReCheck -= 1
-                with self._lock:
-                    self._pendingReCheck += 1
-                self._threads.add( gevent.spawn_later( self._nSecBetweenOnlineChecks, _doReCheck, sensor ) )
-                continue
+    def _performSpotChecks( self ):
+        while not self._stopEvent.is_set():
+            sensor, isNew = self._sensorsLeftToCheck.get()
+            if sensor is None:
+                # Sentinel, the SpotCheck is done or stopping.
+                return
 
-            if self._cbOnStartCheck is not None:
-                self._cbOnStartCheck( sensor )
+            if isNew:
+                self._enumerationSlots.release()
 
-            # By this point we have a sensor and it's likely online.
+            self._nChecking += 1
             try:
-                result = self._cbCheck( sensor )
-            except:
-                # On errors, we notify the callback but assume any retry
-                # is likely to also fail so we won't retry.
-                if self._cbOnError is not None:
-                    self._cbOnError( sensor, traceback.format_exc() )
-                result = True
-            if not result:
-                # We assume the sensor was somehow offline.
-                if self._cbOnOffline is not None:
-                    self._cbOnOffline( sensor )
-                # Re-add it to sensors to check, after the timeout.
-                gevent.sleep( self._nSecBetweenOnlineChecks )
-                self._sensorsLeftToCheck.put( sensor )
-                continue
-
-            # This means the check was done successfully.
-            if self._cbOnCheckDone is not None:
-                self._cbOnCheckDone( sensor )
+                self._checkSensor( sensor )
+            finally:
+                self._nChecking -= 1
+                self._notifyIfDone()
+
+    def _notifyIfDone( self ):
+        with self._lock:
+            if self._isDone:
+                return
+            # Sensors may still be listed, waiting in the queue, waiting
+            # for a re-check or being checked (and become a re-check).
+            if not self._isListed or 0 != self._sensorsLeftToCheck.qsize() or 0 != len( self._reChecks ) or 0 != self._nChecking:
+                return
+            self._isDone = True
+        self._releaseWorkers()
+
+    def _releaseWorkers( self ):
+        if self._reCheckScheduler is not None:
+            self._reCheckScheduler.kill( block = False )
+        # Wake up every worker blocked on the queue.
+        for _ in range( self._nConcurrent ):
+            self._sensorsLeftToCheck.put( ( None, False ) )
+
+    def _checkSensor( self, sensor ):
+        # Check to see if the platform matches
+        if self._skipPlatforms and self._getInfo( sensor )[ 'plat' ] in self._skipPlatforms:
+            return
+
+        # If tags were set, check the sensor have them.
+        if self._tags is not None:
+            sensorTags = self._getTags( sensor )
+            if not self._tags.issubset( sensorTags ):
+                return
+
+        # Check to see if the sensor is online.
+        if not sensor.isOnline():
+            if self._cbOnOffline is not None:
+                self._cbOnOffline( sensor )
+
+            self._reCheckLater( sensor )
+            return
+
+        if self._cbOnStartCheck is not None:
+            self._cbOnStartCheck( sensor )
+
+        # By this point we have a sensor and it's likely online.
+        try:
+            result = self._cbCheck( sensor )
+        except:
+            # On errors, we notify the callback but assume any retry
+            # is likely to also fail so we won't retry.
+            if self._cbOnError is not None:
+                self._cbOnError( sensor, traceback.format_exc() )
+            result = True
+        if not result:
+            # We assume the sensor was somehow offline.
+            if self._cbOnOffline is not None:
+                self._cbOnOffline( sensor )
+            self._reCheckLater( sensor )
+            return
+
+        # This means the check was done successfully.
+        if self._cbOnCheckDone is not None:
+            self._cbOnCheckDone( sensor )
 
 if __name__ == "__main__":
     import argparse
     import getpass
+    import binascii
+    import sys
+
+    class _FileHashAction( argparse.Action ):
+        # Validates the sha256 once at parse time rather than per sensor.
+        def __call__( self, parser, namespace, values, option_string = None ):
+            directory, filePattern, depth, hash = values
+            try:
+                if 32 != len( binascii.unhexlify( hash ) ):
+                    raise ValueError()
+            except ( ValueError, TypeError ):
+                parser.error( 'hash not valid sha256: %s' % ( hash, ) )
+            items = list( getattr( namespace, self.dest, None ) or [] )
+            items.append( ( directory, filePattern, depth, hash.lower() ) )
+            setattr( namespace, self.dest, items )
 
     parser = argparse.ArgumentParser( prog = 'limacharlie.io spotcheck' )
     parser.add_argument( '-o', '--oid',
@@ -212,7 +360,7 @@ if __name__ == "__main__":
                          dest = 'filepatterns',
                          help = 'takes 3 arguments, first is a directory, second is a file pattern like "*.exe", third is the depth of recursion in the directory.' )
     parser.add_argument( '-fh', '--file-hash',
-                         action = 'append',
+                         action = _FileHashAction,
                          nargs = 4,
                          required = False,
                          default = [],
@@ -254,6 +402,34 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    def _escape( path ):
+        return path.replace( '\\', '\\\\' )
+
+    # Yara signatures are read and encoded once for the whole run.
+    yaraSigs = {}
+    for yaraSigFile in set( args.yarasystem ) | set( t[ 0 ] for t in args.yarafiles ) | set( t[ 0 ] for t in args.yaraprocesses ):
+        with open( yaraSigFile, 'rb' ) as f:
+            yaraSigs[ yaraSigFile ] = base64.b64encode( f.read() ).decode()
+
+    # Commands only depend on the arguments so they are generated once
+    # here instead of for every sensor.
+    fileCommands = [ ( 'file_info "%s"' % ( _escape( file ), ), 'file_hash "%s"' % ( _escape( file ), ) ) for file in args.files ]
+    filePatternCommands = [ 'dir_list "%s" "%s" -d %s' % ( _escape( directory ), filePattern, depth ) for directory, filePattern, depth in args.filepatterns ]
+    fileHashCommands = [ 'dir_find_hash "%s" "%s" -d %s --hash %s' % ( _escape( directory ), filePattern, depth, hash ) for directory, filePattern, depth, hash in args.filehashes ]
+    registryKeyCommands = [ 'reg_list "%s"' % ( _escape( regKey ), ) for regKey in args.registrykeys ]
+    # Values are grouped by key so each listing is indexed only once.
+    registryValueCommands = []
+    registryValuesByCommand = {}
+    for regKey, regVal in args.registryvalues:
+        command = 'reg_list "%s"' % ( _escape( regKey ), )
+        if command not in registryValuesByCommand:
+            registryValuesByCommand[ command ] = []
+            registryValueCommands.append( ( command, registryValuesByCommand[ command ] ) )
+        registryValuesByCommand[ command ].append( regVal.lower() )
+    yaraSystemCommands = [ 'yara_scan %s' % ( yaraSigs[ yaraSigFile ], ) for yaraSigFile in args.yarasystem ]
+    yaraFileCommands = [ ( 'dir_list "%s" "%s" -d %s' % ( _escape( directory ), filePattern, depth ), yaraSigs[ yaraSigFile ] ) for yaraSigFile, directory, filePattern, depth in args.yarafiles ]
+    yaraProcessCommands = [ 'yara_scan %s -e %s' % ( yaraSigs[ yaraSigFile ], _escape( procPattern ) ) for yaraSigFile, procPattern in args.yaraprocesses ]
+
     # Get creds if we need them.
     if args.oid is not None:
         secretApiKey = getpass.getpass( prompt = 'Enter secret API key: ' )
@@ -261,111 +437,196 @@ if __name__ == "__main__":
         secretApiKey = None
 
     def _genericSpotCheck( sensor ):
-        global args
-
-        for file in args.files:
-            response = sensor.simpleRequest( 'file_info "%s"' % file.replace( '\\', '\\\\' ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
+        # All sub-checks are independent so they run concurrently, but
+        # bounded to avoid flooding a single sensor with taskings.
+        subChecks = gevent.pool.Pool( size = 8 )
+
+        # Read-only commands repeated across sub-checks (like the same
+        # reg_list for a key and one of its values) are only sent once,
+        # each is sent on behalf of a sub-check holding a pool slot.
+        responseCache = {}
+
+        # The first sub-check to fail aborts the others, its error is
+        # raised once they are all done.
+        errors = []
+
+        def _runSubCheck( f, *args ):
+            # Errors are caught here so the hub does not report each
+            # failed sub-check on top of the error callback.
+            try:
+                f( *args )
+            except Exception as e:
+                if 0 == len( errors ):
+                    errors.append( e )
+                    subChecks.kill( block = False )
 
-            if 0 != response[ 'event' ].get( 'ERROR', 0 ):
-                # File probably not found.
-                continue
+        def _spawn( f, *args ):
+            if 0 != len( errors ):
+                return
+            subChecks.spawn( _runSubCheck, f, *args )
 
-            # File was found.
-            fileInfo = response[ 'event' ]
+        for infoCommand, hashCommand in fileCommands:
+            _spawn( _checkFile, sensor, responseCache, infoCommand, hashCommand )
 
-            # Try to ge the hash.
-            response = sensor.simpleRequest( 'file_hash "%s"' % file.replace( '\\', '\\\\' ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
+        for command in filePatternCommands:
+            _spawn( _checkFilePattern, sensor, responseCache, command )
 
-            fileHash = None
-            if 0 == response[ 'event' ].get( 'ERROR', 0 ):
-                # We got a hash.
-                fileHash = response[ 'event' ]
+        for command in fileHashCommands:
+            _spawn( _checkFileHash, sensor, command )
 
-            _reportHit( sensor, { 'file_info' : fileInfo, 'file_hash' : fileHash } )
+        for command in registryKeyCommands:
+            _spawn( _checkRegistryKey, sensor, responseCache, command )
 
-        for directory, filePattern, depth in args.filepatterns:
-            response = sensor.simpleRequest( 'dir_list "%s" "%s" -d %s' % ( directory.replace( "\\", "\\\\" ), filePattern, depth ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
+        for command, regVals in registryValueCommands:
+            _spawn( _checkRegistryValues, sensor, responseCache, command, regVals )
 
-            for entry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
-                _reportHit( sensor, { 'file_info' : entry } )
+        for command in yaraSystemCommands:
+            _spawn( _checkYara, sensor, command )
 
-        for directory, filePattern, depth, hash in args.filehashes:
-            if 64 != len( hash ):
-                raise Exception( 'hash not valid sha256' )
-            try:
-                hash.decode( 'hex' )
-            except:
-                raise Exception( 'hash contains invalid characters' )
-            response = sensor.simpleRequest( 'dir_find_hash "%s" "%s" -d %s --hash %s' % ( directory.replace( "\\", "\\\\" ), filePattern, depth , hash ), timeout = 3600 )
-            if not response:
-                raise Exception( 'timeout' )
-
-            for entry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
-                _reportHit( sensor, { 'file_hash' : entry } )
-
-        for regKey in args.registrykeys:
-            response = sensor.simpleRequest( 'reg_list "%s"' % ( regKey.replace( '\\', '\\\\' ), ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
-
-            if 0 != response[ 'event' ][ 'ERROR' ]:
-                # Registry probably not found.
-                continue
+        for command, yaraSig in yaraFileCommands:
+            _spawn( _checkYaraFiles, sensor, responseCache, command, yaraSig )
 
-            _reportHit( sensor, { 'reg_key' : response[ 'event' ] } )
+        for command in yaraProcessCommands:
+            _spawn( _checkYara, sensor, command )
 
-        for regKey, regVal in args.registryvalues:
-            response = sensor.simpleRequest( 'reg_list "%s"' % ( regKey.replace( '\\', '\\\\' ), ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
+        try:
+            subChecks.join()
+        finally:
+            subChecks.kill()
+            # Shared requests are not part of the pool, make sure none
+            # outlives an abandoned check.
+            gevent.killall( list( responseCache.values() ) )
 
-            if 0 != response[ 'event' ][ 'ERROR' ]:
-                # Registry probably not found.
-                continue
+        if 0 != len( errors ):
+            raise errors[ 0 ]
 
-            for valEntry in response[ 'event' ][ 'REGISTRY_VALUE' ]:
-                if valEntry.get( 'NAME', '' ).lower() == regVal.lower():
-                    _reportHit( sensor, { 'reg_key' : response[ 'event' ][ 'ROOT' ], 'reg_value' : valEntry } )
-
-        for yaraSigFile in args.yarasystem:
-            with open( yaraSigFile, 'rb' ) as f:
-                yaraSig = base64.b64encode( f.read() )
-            future = sensor.request( 'yara_scan %s' % ( yaraSig, ) )
-            _handleYaraTasking( sensor, future )
-
-        for yaraSigFile, directory, filePattern, depth in args.yarafiles:
-            with open( yaraSigFile, 'rb' ) as f:
-                yaraSig = base64.b64encode( f.read() )
-            response = sensor.simpleRequest( 'dir_list "%s" "%s" -d %s' % ( directory.replace( "\\", "\\\\" ), filePattern, depth ), timeout = 30 )
-            if not response:
-                raise Exception( 'timeout' )
-            for fileEntry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
-                filePath = fileEntry.get( 'FILE_PATH', None )
-                if filePath is None:
-                    continue
-                future = sensor.request( 'yara_scan %s -f "%s"' % ( yaraSig, filePath.replace( "\\", "\\\\" ) ) )
-                _handleYaraTasking( sensor, future )
+        return True
 
-        for yaraSigFile, procPattern in args.yaraprocesses:
-            with open( yaraSigFile, 'rb' ) as f:
-                yaraSig = base64.b64encode( f.read() )
-            future = sensor.request( 'yara_scan %s -e %s' % ( yaraSig, procPattern.replace( '\\', '\\\\' ) ) )
+    def _cachedRequest( sensor, responseCache, command ):
+        # Concurrent sub-checks share the same in-flight request.
+        request = responseCache.get( command, None )
+        if request is None:
+            request = gevent.spawn( _requestOrError, sensor, command )
+            responseCache[ command ] = request
+        return request
+
+    def _requestOrError( sensor, command ):
+        # Errors are returned rather than raised so the hub does not report
+        # them, every sub-check waiting on the request re-raises them.
+        try:
+            return sensor.simpleRequest( command, timeout = 30 )
+        except Exception as e:
+            return e
+
+    def _getResponse( request ):
+        response = request.get()
+        if isinstance( response, Exception ):
+            raise response
+        return response
+
+    def _checkFile( sensor, responseCache, infoCommand, hashCommand ):
+        # Issue the info and hash requests concurrently so the file
+        # costs a single round-trip to the sensor.
+        infoRequest = _cachedRequest( sensor, responseCache, infoCommand )
+        hashRequest = _cachedRequest( sensor, responseCache, hashCommand )
+        gevent.joinall( [ infoRequest, hashRequest ] )
+        infoResponse = _getResponse( infoRequest )
+        hashResponse = _getResponse( hashRequest )
+
+        response = infoResponse
+        if not response:
+            raise Exception( 'timeout' )
+
+        if 0 != response[ 'event' ].get( 'ERROR', 0 ):
+            # File probably not found.
+            return
+
+        # File was found.
+        fileInfo = response[ 'event' ]
+
+        # Try to ge the hash.
+        response = hashResponse
+        if not response:
+            raise Exception( 'timeout' )
+
+        fileHash = None
+        if 0 == response[ 'event' ].get( 'ERROR', 0 ):
+            # We got a hash.
+            fileHash = response[ 'event' ]
+
+        _reportHit( sensor, { 'file_info' : fileInfo, 'file_hash' : fileHash } )
+
+    def _checkFilePattern( sensor, responseCache, command ):
+        response = _getResponse( _cachedRequest( sensor, responseCache, command ) )
+        if not response:
+            raise Exception( 'timeout' )
+
+        for entry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
+            _reportHit( sensor, { 'file_info' : entry } )
+
+    def _checkFileHash( sensor, command ):
+        response = sensor.simpleRequest( command, timeout = 3600 )
+        if not response:
+            raise Exception( 'timeout' )
+
+        for entry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
+            _reportHit( sensor, { 'file_hash' : entry } )
+
+    def _checkRegistryKey( sensor, responseCache, command ):
+        response = _getResponse( _cachedRequest( sensor, responseCache, command ) )
+        if not response:
+            raise Exception( 'timeout' )
+
+        if 0 != response[ 'event' ][ 'ERROR' ]:
+            # Registry probably not found.
+            return
+
+        _reportHit( sensor, { 'reg_key' : response[ 'event' ] } )
+
+    def _checkRegistryValues( sensor, responseCache, command, regVals ):
+        response = _getResponse( _cachedRequest( sensor, responseCache, command ) )
+        if not response:
+            raise Exception( 'timeout' )
+
+        if 0 != response[ 'event' ][ 'ERROR' ]:
+            # Registry probably not found.
+            return
+
+        valuesByName = dict( ( valEntry.get( 'NAME', '' ).lower(), valEntry ) for valEntry in response[ 'event' ][ 'REGISTRY_VALUE' ] )
+        for regVal in regVals:
+            valEntry = valuesByName.get( regVal, None )
+            if valEntry is not None:
+                _reportHit( sensor, { 'reg_key' : response[ 'event' ][ 'ROOT' ], 'reg_value' : valEntry } )
+
+    def _checkYara( sensor, command ):
+        future = sensor.request( command )
+        _handleYaraTasking( sensor, future )
+
+    def _checkYaraFiles( sensor, responseCache, command, yaraSig ):
+        response = _getResponse( _cachedRequest( sensor, responseCache, command ) )
+        if not response:
+            raise Exception( 'timeout' )
+        for fileEntry in response[ 'event' ][ 'DIRECTORY_LIST' ]:
+            filePath = fileEntry.get( 'FILE_PATH', None )
+            if filePath is None:
+                continue
+            future = sensor.request( 'yara_scan %s -f "%s"' % ( yaraSig, _escape( filePath ) ) )
             _handleYaraTasking( sensor, future )
 
-        return True
-
     def _handleYaraTasking( sensor, future ):
         isDone = False
+        # Wait in short increments so that stopping the SpotCheck is
+        # honored, but only time out after an hour without responses.
+        deadline = time.time() + 3600
         while True:
-            responses = future.getNewResponses( timeout = 3600 )
+            if checker.isStopped():
+                raise Exception( 'stopped' )
+            responses = future.getNewResponses( timeout = 30 )
             if not responses:
-                raise Exception( 'timeout' )
+                if time.time() > deadline:
+                    raise Exception( 'timeout' )
+                continue
+            deadline = time.time() + 3600
             for response in responses:
                 if 'done' == response[ 'event' ].get( 'ERROR_MESSAGE', None ):
                     isDone = True
@@ -380,20 +641,39 @@ if __name__ == "__main__":
             if isDone:
                 break
 
+    # All output goes through a single writer so that concurrent
+    # sub-checks and sensors never interleave their lines.
+    outputQueue = Queue()
+
+    def _outputWriter():
+        while True:
+            msg = outputQueue.get()
+            if msg is None:
+                break
+            sys.stdout.write( msg )
+            if 0 == outputQueue.qsize():
+                sys.stdout.flush()
+        sys.stdout.flush()
+
+    outputWriter = gevent.spawn( _outputWriter )
+
+    # A single compact encoder reused for every hit.
+    encodeJson = json.JSONEncoder( separators = ( ',', ':' ) ).encode
+
     def _reportHit( sensor, mtd ):
-        print( "! (%s / %s): %s" % ( sensor, sensor.hostname(), json.dumps( mtd  ) ) )
+        outputQueue.put( "! (%s / %s): %s\n" % ( sensor, sensor.hostname(), encodeJson( mtd ) ) )
 
     def _onError( sensor, error ):
-        print( "X (%s / %s): %s" % ( sensor, sensor.hostname(), error ) )
+        outputQueue.put( "X (%s / %s): %s\n" % ( sensor, sensor.hostname(), error ) )
 
     def _onOffline( sensor ):
-        print( "? (%s / %s)" % ( sensor, sensor.hostname() ) )
+        outputQueue.put( "? (%s / %s)\n" % ( sensor, sensor.hostname() ) )
 
     def _onDone( sensor ):
-        print( ". (%s / %s)" % ( sensor, sensor.hostname() ) )
+        outputQueue.put( ". (%s / %s)\n" % ( sensor, sensor.hostname() ) )
 
     def _onStartCheck( sensor ):
-        print( "> (%s / %s)" % ( sensor, sensor.hostname() ) )
+        outputQueue.put( "> (%s / %s)\n" % ( sensor, sensor.hostname() ) )
 
     checker = SpotCheck( args.oid,
                          secretApiKey,
@@ -402,10 +682,15 @@ if __name__ == "__main__":
                          cb_on_check_done = _onDone,
                          cb_on_offline = _onOffline,
                          cb_on_error = _onError,
+                         n_concurrent = args.nConcurrent,
                          is_windows = args.is_windows,
                          is_linux = args.is_linux,
                          is_macos = args.is_macos,
                          tags = args.tags,
                          extra_params = args.extra_params )
     checker.start()
-    checker.wait( 60 * 60 * 24 * 30 * 365 )
\ No newline at end of file
+    checker.wait( 60 * 60 * 24 * 30 * 365 )
+
+    # Drain any pending output before exiting.
+    outputQueue.put( None )
+    outputWriter.join()
\ No newline at end of file